@@ -7,31 +7,154 @@ annotations.
 """
 
 import argparse
+import concurrent.futures
+import functools
+import io
+import os
 from Bio import SeqIO
+from Bio.Data import CodonTable
+from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.SeqFeature import FeatureLocation
 import sys
-from typing import List
+from typing import IO, List, Optional
+
+# ISA-L's igzip is a drop-in replacement for gzip with much faster decompression
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+READ_BUFFER_SIZE = 1 << 20
+WRITE_BUFFER_SIZE = 1 << 20
+# GBFF feature table layout: qualifiers start at column 22 and lines end by column 79
+QUALIFIER_INDENT = 21
+QUALIFIER_WIDTH = 58
+# Translation runs at roughly 0.2us per codon, so starting a process pool (tens of ms including pickling)
+# only pays off for genomes far larger than a typical virus
+PARALLEL_MIN_CODONS = 1 << 20
+
+# Map nucleotides to 2-bit codes; any other byte keeps its own value (>= 4)
+_NUC_CODES = bytes.maketrans(b"ACGTUacgtu", bytes([0, 1, 2, 3, 3, 0, 1, 2, 3, 3]))
+
+
+def _make_codon_table() -> bytes:
+    """Return a 64-entry standard genetic code lookup indexed by 2-bit packed codons."""
+    table = CodonTable.standard_dna_table
+    codon_table = bytearray(64)
+    for idx in range(64):
+        codon = "".join("ACGT"[(idx >> shift) & 3] for shift in (4, 2, 0))
+        amino_acid = "*" if codon in table.stop_codons else table.forward_table[codon]
+        codon_table[idx] = ord(amino_acid)
+    return bytes(codon_table)
+
+
+CODON_TABLE = _make_codon_table()
+
+# IUPAC nucleotide complements, for reverse-complementing with bytes.translate
+_COMPLEMENT = bytes.maketrans(b"ACGTRYKMBVDHSWNacgtrykmbvdhswn",
+                              b"TGCAYRMKVBHDSWNtgcayrmkvbhdswn")
+
+
+def _open_input(path: str, mode: str = "r") -> IO:
+    """Open a file for reading, decompressing it if the name ends in .gz."""
+    if path.endswith(".gz"):
+        handle = io.BufferedReader(gzip.open(path, "rb"), buffer_size=READ_BUFFER_SIZE)
+        return handle if "b" in mode else io.TextIOWrapper(handle)
+    return open(path, mode, buffering=READ_BUFFER_SIZE)
+
+
+def _open_output(path: str, mode: str = "w") -> IO:
+    """Open a file for writing, compressing it if the name ends in .gz."""
+    if path.endswith(".gz"):
+        handle = io.BufferedWriter(gzip.open(path, "wb"), buffer_size=WRITE_BUFFER_SIZE)
+        return handle if "b" in mode else io.TextIOWrapper(handle)
+    return open(path, mode, buffering=WRITE_BUFFER_SIZE)
 
 
 def read_fasta_one_sequence(fasta_path: str) -> SeqRecord:
     """Read a FASTA file and return the single SeqRecord it contains."""
-    records = list(SeqIO.parse(fasta_path, "fasta"))
+    with _open_input(fasta_path) as f:
+        records = list(SeqIO.parse(f, "fasta"))
     if len(records) != 1:
         raise ValueError(f"FASTA file {fasta_path} must contain exactly one sequence.")
     return records[0]
 
 
-def read_gbff_accession(gbff_path: str, accession: str) -> SeqRecord:
-    """Read a GBFF file and return the SeqRecord with the specified accession."""
-    for record in SeqIO.parse(gbff_path, "genbank"):
-        if record.id == accession:
-            return record
+def read_gbff_record_lines(gbff_path: str, accession: str) -> List[bytes]:
+    """Return the raw lines (LOCUS through //) of the GBFF record with the specified accession.
+
+    The flat file is scanned line by line for the record whose VERSION (or ACCESSION) matches,
+    without parsing any records.
+    """
+    target = accession.encode()
+    with _open_input(gbff_path, "rb") as f:
+        record_lines = None
+        found = False
+        for line in f:
+            if line.startswith(b"LOCUS "):
+                record_lines = [line]
+                found = False
+                continue
+            if record_lines is None:
+                continue
+            record_lines.append(line)
+            if line.startswith((b"ACCESSION", b"VERSION")):
+                ids = line.split()[1:]
+                if ids and ids[0] == target:
+                    found = True
+                elif line.startswith(b"VERSION") and not found:
+                    # Not the record we want, stop collecting until the next LOCUS
+                    record_lines = None
+            elif line.startswith(b"//"):
+                if found:
+                    return record_lines
+                record_lines = None
     raise ValueError(f"Accession {accession} not found in GBFF file {gbff_path}.")
 
 
-def alter_gbff(gbff_record: SeqRecord, fasta_record: SeqRecord) -> SeqRecord:
-    """Alter the sequence of the specified accession in the GBFF file."""
+def parse_gbff_record_lines(record_lines: List[bytes]) -> SeqRecord:
+    """Parse the raw lines of one GBFF record into a SeqRecord."""
+    return SeqIO.read(io.StringIO(b"".join(record_lines).decode()), "genbank")
+
+
+def read_gbff_accession(gbff_path: str, accession: str) -> SeqRecord:
+    """Read a GBFF file and return the SeqRecord with the specified accession.
+
+    Only the matching record is handed to Biopython, so non-matching records are never parsed.
+    """
+    return parse_gbff_record_lines(read_gbff_record_lines(gbff_path, accession))
+
+
+@functools.lru_cache(maxsize=None)
+def _translate_ambiguous_codon(codon: bytes) -> int:
+    """Translate a codon with non-ACGT bases using Biopython's ambiguity handling."""
+    return ord(str(Seq(codon.decode()).translate()))
+
+
+def reverse_complement(seq: bytes) -> bytes:
+    """Return the reverse complement of a nucleotide sequence."""
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def translate_cds(seq: bytes) -> str:
+    """Translate a nucleotide sequence with the standard genetic code, like Seq.translate()."""
+    codes = seq.translate(_NUC_CODES)
+    protein = bytearray(len(codes) // 3)
+    for aa_idx, (b0, b1, b2) in enumerate(zip(codes[0::3], codes[1::3], codes[2::3])):
+        if (b0 | b1 | b2) < 4:
+            protein[aa_idx] = CODON_TABLE[(b0 << 4) | (b1 << 2) | b2]
+        else:
+            protein[aa_idx] = _translate_ambiguous_codon(seq[3 * aa_idx:3 * aa_idx + 3])
+    return protein.decode("ascii")
+
+
+def alter_gbff(gbff_record: SeqRecord, fasta_record: SeqRecord,
+               executor: Optional[concurrent.futures.Executor] = None) -> SeqRecord:
+    """Alter the sequence of the specified accession in the GBFF file.
+
+    CDS translations are run on executor if given, so that callers altering many records can share one pool.
+    """
     # Create a new SeqRecord with the altered sequence
     altered_record = SeqRecord(
         seq=fasta_record.seq,
@@ -41,37 +164,130 @@ def alter_gbff(gbff_record: SeqRecord, fasta_record: SeqRecord) -> SeqRecord:
         annotations=gbff_record.annotations,
         features=gbff_record.features
     )
+    seq_bytes = bytes(fasta_record.seq)
+    cds_features = []
+    cds_seqs = []
     for feature in altered_record.features:
-        # If feature includes sequence, replace the sequence using the altered sequence
-        if feature.type in {"CDS", "gene", "mRNA"}:
-            if isinstance(feature.location, FeatureLocation):
-                start = int(feature.location.start)
-                end = int(feature.location.end)
-                strand = feature.location.strand
-                feature_seq = altered_record.seq[start:end]
-                if strand == -1:
-                    feature_seq = feature_seq.reverse_complement()
-                if feature.type == "CDS":
-                    # Update the translation in the feature's qualifiers
-                    translation = str(feature_seq.translate(to_stop=False))
-                    feature.qualifiers["translation"] = [translation]
+        # Of the features that include sequence, only CDS has a qualifier derived from it
+        if feature.type == "CDS" and isinstance(feature.location, FeatureLocation):
+            feature_seq = seq_bytes[int(feature.location.start):int(feature.location.end)]
+            if feature.location.strand == -1:
+                feature_seq = reverse_complement(feature_seq)
+            cds_features.append(feature)
+            cds_seqs.append(feature_seq)
+    # Translations are independent, so spread them across processes when there is enough work to cover the startup
+    chunksize = max(1, len(cds_seqs) // (4 * (os.cpu_count() or 1)))
+    if executor is not None:
+        translations = list(executor.map(translate_cds, cds_seqs, chunksize=chunksize))
+    elif (os.cpu_count() or 1) > 1 and sum(map(len, cds_seqs)) // 3 >= PARALLEL_MIN_CODONS:
+        with concurrent.futures.ProcessPoolExecutor() as pool:
+            translations = list(pool.map(translate_cds, cds_seqs, chunksize=chunksize))
+    else:
+        translations = [translate_cds(feature_seq) for feature_seq in cds_seqs]
+    for feature, translation in zip(cds_features, translations):
+        # Update the translation in the feature's qualifiers
+        feature.qualifiers["translation"] = [translation]
     return altered_record
 
 
 def write_gbff(records: List[SeqRecord], output_path: str):
     """Write the list of SeqRecords to a GBFF file."""
-    with open(output_path, "w") as output_handle:
+    with _open_output(output_path) as output_handle:
         SeqIO.write(records, output_handle, "genbank")
 
 
-def alter_gbff_file(gbff_file: str, accession: str, fasta_file: str, output_file: str):
+def format_translation(translation: str) -> List[bytes]:
+    """Format a /translation qualifier as GBFF feature table lines, wrapped like NCBI's."""
+    qualifier = f'/translation="{translation}"'.encode()
+    return [b" " * QUALIFIER_INDENT + qualifier[i:i + QUALIFIER_WIDTH] + b"\n"
+            for i in range(0, len(qualifier), QUALIFIER_WIDTH)]
+
+
+def format_origin(seq: bytes) -> List[bytes]:
+    """Format a sequence as the lines of a GBFF ORIGIN block (not including the ORIGIN line)."""
+    seq = seq.lower()
+    lines = []
+    for line_start in range(0, len(seq), 60):
+        blocks = [seq[i:i + 10] for i in range(line_start, min(line_start + 60, len(seq)), 10)]
+        lines.append(b"%9d " % (line_start + 1) + b" ".join(blocks) + b"\n")
+    return lines
+
+
+def patch_gbff_record_lines(record_lines: List[bytes], altered_record: SeqRecord) -> Optional[List[bytes]]:
+    """Return a copy of a GBFF record's lines with CDS translations and the ORIGIN sequence taken from
+    altered_record, which must have been parsed from the same lines.  All other lines are copied
+    verbatim.  Return None if the record can't be patched in place (e.g. it has no ORIGIN block)."""
+    features = altered_record.features
+    out_lines = []
+    in_features = False
+    feature_idx = -1
+    pending_translation = None
+    skipping_translation = False
+    in_origin = False
+    origin_written = False
+    for line in record_lines:
+        if in_origin:
+            if line.startswith(b"//"):
+                out_lines.extend(format_origin(bytes(altered_record.seq)))
+                out_lines.append(line)
+                in_origin = False
+                origin_written = True
+            continue
+        if skipping_translation:
+            # Drop continuation lines of the old translation up to its closing quote
+            skipping_translation = b'"' not in line
+            continue
+        if in_features:
+            is_feature_start = line.startswith(b"     ") and line[5:6] not in (b" ", b"\n")
+            if is_feature_start or not line.startswith(b" "):
+                # Leaving the previous feature; add its translation if it didn't have one yet
+                if pending_translation is not None:
+                    out_lines.extend(format_translation(pending_translation))
+                    pending_translation = None
+            if is_feature_start:
+                feature_idx += 1
+                if feature_idx >= len(features):
+                    return None
+                feature = features[feature_idx]
+                if feature.type == "CDS" and "translation" in feature.qualifiers:
+                    pending_translation = feature.qualifiers["translation"][0]
+            elif not line.startswith(b" "):
+                in_features = False
+            elif pending_translation is not None and line[QUALIFIER_INDENT:].startswith(b"/translation="):
+                out_lines.extend(format_translation(pending_translation))
+                pending_translation = None
+                skipping_translation = line.count(b'"') < 2
+                continue
+        if line.startswith(b"FEATURES"):
+            in_features = True
+        elif line.startswith(b"ORIGIN"):
+            in_origin = True
+        out_lines.append(line)
+    if feature_idx + 1 != len(features) or not origin_written:
+        return None
+    return out_lines
+
+
+def alter_gbff_file(gbff_file: str, accession: str, fasta_file: str, output_file: str,
+                    executor: Optional[concurrent.futures.Executor] = None):
     fasta_record = read_fasta_one_sequence(fasta_file)
-    gbff_record = read_gbff_accession(gbff_file, accession)
+    record_lines = read_gbff_record_lines(gbff_file, accession)
+    gbff_record = parse_gbff_record_lines(record_lines)
     if len(gbff_record.seq) != len(fasta_record.seq):
         print("Error: The length of the FASTA sequence must match the length of the GBFF sequence.", file=sys.stderr)
         sys.exit(1)
-    altered_record = alter_gbff(gbff_record, fasta_record)
-    write_gbff([altered_record], output_file)
+    altered_record = alter_gbff(gbff_record, fasta_record, executor)
+    # Patching the original text is much cheaper than having SeqIO.write re-format the whole record
+    out_lines = patch_gbff_record_lines(record_lines, altered_record)
+    if out_lines is None:
+        # Keep the header of the original record, as the patched text does
+        altered_record.id = gbff_record.id
+        altered_record.name = gbff_record.name
+        altered_record.description = gbff_record.description
+        write_gbff([altered_record], output_file)
+    else:
+        with _open_output(output_file, "wb") as output_handle:
+            output_handle.writelines(out_lines)
 
 
 def main():
@@ -0,0 +1,196 @@
+"""
+Helpers shared by the tree_time scripts (run_treetime.py, tree_time.py, tree_time_updated.py).
+"""
+
+import csv
+import hashlib
+import io
+import os
+import re
+import shutil
+import subprocess
+from typing import IO, Dict, Optional, Tuple
+
+import pandas as pd
+
+# ISA-L's igzip is a drop-in replacement for gzip with much faster decompression
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+# rapidgzip decompresses a single gzip stream on all available cores
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+READ_BUFFER_SIZE = 1 << 20
+WRITE_BUFFER_SIZE = 1 << 20
+METADATA_CHUNK_ROWS = 1 << 20
+
+BRANCH_LENGTH_RE = re.compile(rb':([0-9.eE+-]+)(?=[,);\[])')
+YEAR_PREFIX_RE = re.compile(r'[0-9]{4}')
+YEAR_ONLY_RE = re.compile(r'[0-9]{4}\Z')
+YEAR_MONTH_RE = re.compile(r'[0-9]{4}-[0-9]{2}\Z')
+
+# Stamps and gzip indexes are kept here instead of next to the data, so nothing is added to the viral_usher_trees clone
+CACHE_DIR = os.environ.get("REROOT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+
+
+def cache_path(data_path: str, suffix: str) -> str:
+    """Return the path in CACHE_DIR for a file derived from data_path, e.g. its gzip index or a stamp.
+
+    The name includes a hash of the absolute path because every tree directory has files with the same names.
+    CACHE_DIR is created if needed; if that fails, writing to the returned path fails too and callers carry on.
+    """
+    abs_path = os.path.abspath(data_path)
+    digest = hashlib.sha1(abs_path.encode()).hexdigest()[:16]
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+    except OSError:
+        pass
+    return os.path.join(CACHE_DIR, f"{os.path.basename(abs_path)}.{digest}{suffix}")
+
+
+class _RapidgzipReader(io.BufferedReader):
+    """Buffered parallel gzip reader that reuses a saved seek-point index, or saves one when closed.
+
+    The index is only an optimization: if it can't be read or written, reading carries on without it.
+    """
+
+    def __init__(self, path: str, index_path: Optional[str] = None):
+        gz_file = rapidgzip.RapidgzipFile(path, parallelization=0)
+        try:
+            self._export_index_path = None
+            if index_path is not None:
+                if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+                    try:
+                        gz_file.import_index(index_path)
+                    except (RuntimeError, OSError):
+                        # Damaged index, e.g. left by an interrupted run; start over and replace it
+                        gz_file.close()
+                        gz_file = rapidgzip.RapidgzipFile(path, parallelization=0)
+                        self._export_index_path = index_path
+                else:
+                    self._export_index_path = index_path
+            super().__init__(gz_file, buffer_size=READ_BUFFER_SIZE)
+        except BaseException:
+            gz_file.close()
+            raise
+
+    def _export_index(self, index_path: str):
+        """Save the index via a temporary file so that an interrupted export never leaves a partial index."""
+        tmp_index_path = f"{index_path}.{os.getpid()}.tmp"
+        try:
+            self.raw.export_index(tmp_index_path)
+            os.replace(tmp_index_path, index_path)
+        except (RuntimeError, OSError):
+            try:
+                os.remove(tmp_index_path)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._export_index_path is not None:
+                self._export_index(self._export_index_path)
+                self._export_index_path = None
+        finally:
+            try:
+                super().close()
+            finally:
+                # rapidgzip aborts the interpreter at exit if its reader threads are still running
+                self.raw.close()
+
+
+def open_maybe_gzip(path: str, mode: str = "r", index_path: Optional[str] = None) -> IO:
+    """Open a file for reading, decompressing it if the name ends in .gz.
+
+    If rapidgzip is installed and index_path is given, the gzip index is kept in index_path so that
+    later reads of an unchanged file can skip searching for deflate block boundaries.
+    """
+    path = os.fspath(path)
+    if path.endswith(".gz"):
+        if rapidgzip is not None:
+            handle = _RapidgzipReader(path, index_path)
+        else:
+            handle = io.BufferedReader(gzip.open(path, "rb"), buffer_size=READ_BUFFER_SIZE)
+        return handle if "b" in mode else io.TextIOWrapper(handle)
+    return open(path, mode, buffering=READ_BUFFER_SIZE)
+
+
+def open_output(path: str, mode: str = "w") -> IO:
+    """Open a file for writing, compressing it if the name ends in .gz."""
+    path = os.fspath(path)
+    if path.endswith(".gz"):
+        handle = io.BufferedWriter(gzip.open(path, "wb"), buffer_size=WRITE_BUFFER_SIZE)
+        return handle if "b" in mode else io.TextIOWrapper(handle)
+    return open(path, mode, buffering=WRITE_BUFFER_SIZE)
+
+
+def run_command(command, **kwargs) -> subprocess.CompletedProcess:
+    """Run command with subprocess.run, set up so that CPython can start it with posix_spawn
+    instead of fork+exec, which has to copy the page tables of this process once pandas is loaded"""
+    # posix_spawn needs a path to the executable, stdin not inherited, and close_fds=False,
+    # which is safe because Python opens files non-inheritable by default
+    executable = shutil.which(command[0]) or command[0]
+    return subprocess.run([executable] + command[1:], stdin=subprocess.DEVNULL, close_fds=False, **kwargs)
+
+
+def read_dates(f: IO, name_idx: int, date_idx: int) -> Tuple[Dict[str, str], int, int]:
+    """Read the rest of a binary metadata TSV handle whose header has been consumed.
+
+    Return a dict of names -> dates for rows whose date starts with a year, the number of those rows,
+    and the total number of rows.
+    """
+    name_to_date = {}
+    real_date_count = 0
+    line_count = 0
+    # Let pandas' C tokenizer split the file, keeping only the two columns we need
+    for chunk in pd.read_csv(f, sep="\t", header=None, usecols=[name_idx, date_idx], dtype=str,
+                             keep_default_na=False, quoting=csv.QUOTE_NONE, engine="c",
+                             chunksize=METADATA_CHUNK_ROWS):
+        dates = chunk[date_idx]
+        has_date = dates.str.match(YEAR_PREFIX_RE)
+        name_to_date.update(zip(chunk[name_idx][has_date], dates[has_date]))
+        real_date_count += int(has_date.sum())
+        line_count += len(chunk)
+    return name_to_date, real_date_count, line_count
+
+
+def pad_date(date: str) -> str:
+    """Fill in a missing month and/or day with -XX, as treetime expects."""
+    if YEAR_ONLY_RE.match(date):
+        return date + "-XX-XX"
+    if YEAR_MONTH_RE.match(date):
+        return date + "-XX"
+    return date
+
+
+def scale_newick(newick: bytes, scale: float) -> bytes:
+    """Multiply every branch length in newick text by scale, leaving the rest untouched."""
+    def scale_match(match):
+        length = float(match.group(1)) * scale
+        # Format lengths the way treeswift did: whole numbers without a trailing .0
+        return b":" + (str(int(length)) if length.is_integer() else repr(length)).encode()
+    return BRANCH_LENGTH_RE.sub(scale_match, newick)
+
+
+def read_stamp(stamp_path: str) -> Optional[str]:
+    """Return the contents of a stamp file, or None if it does not exist."""
+    if not os.path.exists(stamp_path):
+        return None
+    with open(stamp_path) as f:
+        return f.read()
+
+
+def write_stamp(stamp_path: str, stamp: str):
+    """Save a stamp for read_stamp; a stamp only saves work on the next run, so failing to write one is ignored."""
+    try:
+        with open(stamp_path, "w") as f:
+            f.write(stamp)
+    except OSError:
+        pass
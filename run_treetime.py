@@ -8,103 +8,107 @@ Then apply the same rerooting to optimized.pb.gz.
 """
 
 import argparse
-import csv
+import functools
 import gzip
+import numpy as np
 import os
-import re
-import subprocess
+import pathlib
 import sys
 import tempfile
-import treeswift
+try:
+    import tomllib
+except ModuleNotFoundError:  # Python < 3.11
+    import tomli as tomllib
 import alter_gbff
+import pipeline_utils
 
 default_min_real_dates = 0.8
 
-
 def get_dates(subdir_path):
     """Scan metadata.tsv.gz, return a dict of names -> dates and the proportion of real date values to total count"""
-    name_to_date = {}
-    with gzip.open(subdir_path + "/metadata.tsv.gz", "rt") as f:
-        header = [field.strip() for field in f.readline().split('\t')]
+    metadata_path = os.path.join(subdir_path, "metadata.tsv.gz")
+    index_path = pipeline_utils.cache_path(metadata_path, ".gzidx")
+    with pipeline_utils.open_maybe_gzip(metadata_path, "rb", index_path=index_path) as f:
+        header = [field.strip() for field in f.readline().decode().split('\t')]
         name_idx = header.index('accession')
         if name_idx < 0:
-            print(subdir_path + "/metadata.tsv.gz does not have accession column", file=sys.stderr)
+            print(metadata_path + " does not have accession column", file=sys.stderr)
             sys.exit(1)
         date_idx = header.index('date')
         if date_idx < 0:
-            print(subdir_path + "/metadata.tsv.gz does not have date column", file=sys.stderr)
+            print(metadata_path + " does not have date column", file=sys.stderr)
             sys.exit(1)
-        line_count = 0
-        real_date_count = 0
-        for line in f:
-            fields = line.rstrip().split("\t")
-            name = fields[name_idx]
-            date = fields[date_idx]
-            if re.match('^[0-9]{4}', date):
-                name_to_date[name] = date
-                real_date_count += 1
-            line_count += 1
+        name_to_date, real_date_count, line_count = pipeline_utils.read_dates(f, name_idx, date_idx)
     return name_to_date, (real_date_count / line_count)
 
 
 def scale_branch_lengths(subdir_path, newick_out, refseq_len):
-    """Use treeswift (included with taxoniumtools) to scale branch lengths as expected by treetime"""
-    tmp_newick_path = subdir_path + "/optimized.nwk"
+    """Scale branch lengths to substitutions per site as expected by treetime"""
+    input_path = os.path.join(subdir_path, "optimized.pb.gz")
+    newick_out_path = os.path.join(subdir_path, newick_out)
+    # Skip the work if the output was made from the same input file and reference length
+    stamp_path = pipeline_utils.cache_path(newick_out_path, ".stamp")
+    stamp = repr((os.path.getmtime(input_path), refseq_len))
+    if os.path.exists(newick_out_path) and pipeline_utils.read_stamp(stamp_path) == stamp:
+        return
+    tmp_newick_path = os.path.join(subdir_path, "optimized.nwk")
     command = ["matUtils", "extract",
-               "-i", subdir_path + "/optimized.pb.gz",
+               "-i", input_path,
                "-t", tmp_newick_path]
     try:
-        subprocess.run(command, check=True)
+        pipeline_utils.run_command(command, check=True)
     except Exception as e:
         print(f"matUtils command ({' '.join(command)}) failed: {e}", file=sys.stderr)
         sys.exit(1)
-    tree = treeswift.read_tree_newick(tmp_newick_path)
-    tree.scale_edges(1.0 / refseq_len)
-    tree.write_tree_newick(subdir_path + "/" + newick_out)
+    with open(tmp_newick_path, "rb") as f:
+        newick = f.read()
+    with open(newick_out_path, "wb") as f:
+        f.write(pipeline_utils.scale_newick(newick, 1.0 / refseq_len))
     os.remove(tmp_newick_path)
+    pipeline_utils.write_stamp(stamp_path, stamp)
 
 
 def make_dates_csv(subdir_path, dates_out, name_to_date):
     """Write a CSV file of names and dates, fillin in missing month and/or day with -XX"""
-    with open(subdir_path + "/" + dates_out, "w") as f:
+    with open(os.path.join(subdir_path, dates_out), "w") as f:
         f.write(",".join(["name", "date"]) + "\n")
         for name, date in name_to_date.items():
-            if re.match('^[0-9]{4}$', date):
-                date += "-XX-XX"
-            elif re.match('^[0-9]{4}-[0-9]{2}$', date):
-                date += "-XX"
-            f.write(",".join([name, date]) + "\n")
+            f.write(",".join([name, pipeline_utils.pad_date(date)]) + "\n")
 
 
 def get_refseq_len(subdir_path):
-    """Get refseq_length value from output_stats.tsv"""
-    with open(subdir_path + "/output_stats.tsv", "r", newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f, delimiter='\t')
-        fieldnames = reader.fieldnames
-        if "ref_length" not in fieldnames:
+    """Get refseq_length value from output_stats.tsv (the same on every row, so only the first is read)"""
+    with open(os.path.join(subdir_path, "output_stats.tsv"), "r", encoding='utf-8') as f:
+        header = f.readline().rstrip("\r\n").split("\t")
+        if "ref_length" not in header:
             print("output_stats.tsv file does not have ref_length column", file=sys.stderr)
             sys.exit(1)
-        for row in reader:
-            ref_length = int(row["ref_length"])
-    return ref_length
+        first_row = f.readline().rstrip("\r\n").split("\t")
+    return int(first_row[header.index("ref_length")])
 
 
 def run_treetime(path, min_real_dates):
     """Format input for treetime clock, run it and apply the same rooting to optimized.pb.gz"""
-    tree = path.strip("/") + "/optimized.pb.gz"
-    path = path.strip("/")
+    path = pathlib.Path(path)
+    tree = path / "optimized.pb.gz"
 
-    if not os.path.isfile(tree):
+    # One directory listing answers all of the existence checks
+    try:
+        with os.scandir(path) as entries:
+            files = {entry.name for entry in entries if entry.is_file()}
+    except OSError:
+        files = set()
+    if tree.name not in files:
         print(f"Tree file {tree} not found, check spelling", file=sys.stderr)
         sys.exit(1)
 
-    if not os.path.exists(path + "/metadata.tsv.gz") or not os.path.exists(path + "/output_stats.tsv"):
+    if "metadata.tsv.gz" not in files or "output_stats.tsv" not in files:
         print(f"Expected files not found in {path}, has the tree been built?", file=sys.stderr)
         sys.exit(1)
     
     name_to_date, real_dates_proportion = get_dates(path)
     if real_dates_proportion < min_real_dates:
-        with open(path + "/treetime.log", "w") as log_file:
+        with open(path / "treetime.log", "w") as log_file:
             log_file.write(f"Tree {tree} has too low a proportion of dates ({real_dates_proportion:.2f} < {min_real_dates:.2f}), not running treetime. \n")
         #print(f"Tree {tree} has too low a proportion of dates ({real_dates_proportion:.2f} < {min_real_dates:.2f}), not running treetime. ")
         sys.exit(0)
@@ -113,13 +117,13 @@ def run_treetime(path, min_real_dates):
     make_dates_csv(path, "dates.csv", name_to_date)
     command = ["treetime", "clock",
                "--sequence-length", str(refseq_len),
-               "--tree",  path + "/optimized.scaled.nwk",
-               "--dates", path + "/dates.csv",
-               "--outdir", path + "/treetime_out"]
+               "--tree",  str(path / "optimized.scaled.nwk"),
+               "--dates", str(path / "dates.csv"),
+               "--outdir", str(path / "treetime_out")]
     try:
         #subprocess.run(command, check=True)
-        with open(path + "/treetime.log", "w") as log_file:
-            subprocess.run(command, stdout=log_file)
+        with open(path / "treetime.log", "w") as log_file:
+            pipeline_utils.run_command(command, stdout=log_file)
     except Exception as e:
         print(f"treetime command ({' '.join(command)}) failed: {e}", file=sys.stderr)
         sys.exit(1)
@@ -128,46 +132,38 @@ def run_treetime(path, min_real_dates):
 def get_oldest_node(tree):
     """Extract the oldest internal node date from treetime's output file rtt.csv"""
     # oldest_node=$(grep ^node_ treetime_out/rtt.csv | sort -t, -k2n | head -1 | cut -d, -f 1)
-    tree= tree.strip("/")
-    rtt_csv_path = "/".join([tree, "treetime_out", "rtt.csv"])
-    min_date = None
-    oldest_node = None
+    rtt_csv_path = pathlib.Path(tree) / "treetime_out" / "rtt.csv"
     with open(rtt_csv_path) as f:
-        for line in f:
-            columns = line.split(",")
-            if columns[0].startswith("node_"):
-                date = float(columns[1].strip())
-                if min_date is None or date < min_date:
-                    min_date = date
-                    oldest_node = columns[0].strip()
-    if oldest_node is None:
+        # Tips may have date ranges instead of numbers, so keep only the internal node rows
+        node_lines = [line for line in f if line.startswith("node_")]
+    dates = np.loadtxt(node_lines, delimiter=",", usecols=1, ndmin=1) if node_lines else np.empty(0)
+    if dates.size == 0 or np.isnan(dates).all():
         print(f"Failed to get oldest node from {rtt_csv_path}", file=sys.stderr)
         sys.exit(1)
+    oldest_node = node_lines[np.nanargmin(dates)].split(",", 1)[0].strip()
     return oldest_node
 
 
+@functools.lru_cache(maxsize=None)
 def get_refseq_acc(config_path):
     """Return the value of refseq_acc from config.toml"""
-    refseq_acc = None
-    with open(config_path) as f:
-        for line in f:
-            if line.startswith("refseq_acc = "):
-                refseq_acc = line.split("'")[1]
-    if refseq_acc is None:
+    with open(config_path, "rb") as f:
+        config = tomllib.load(f)
+    if "refseq_acc" not in config:
         print(f"Failed to find refseq_acc in {config_path}", file=sys.stderr)
         sys.exit(1)
-    return refseq_acc
+    return config["refseq_acc"]
 
 
 def reroot_tree(tree, oldest_node):
     """Reroot optimized.pb.gz to oldest_node using matUtils and return path to rerooted .pb.gz."""
-    tree = tree.strip("/")
-    input_path = "/".join([tree, "optimized.pb.gz"])
-    rerooted_tree_path = "/".join([tree, "timetree_rerooted.pb.gz"])
-    config_path = "/".join([tree, "config.toml"])
+    tree = pathlib.Path(tree)
+    input_path = str(tree / "optimized.pb.gz")
+    rerooted_tree_path = str(tree / "timetree_rerooted.pb.gz")
+    config_path = str(tree / "config.toml")
     refseq_acc = get_refseq_acc(config_path)
-    ref_path = "/".join([tree, refseq_acc + ".fa"])
-    modified_ref_path = "/".join([tree, "treetime_rerooted_" + refseq_acc + ".fa"])
+    ref_path = str(tree / (refseq_acc + ".fa"))
+    modified_ref_path = str(tree / ("treetime_rerooted_" + refseq_acc + ".fa"))
     command = ["matUtils", "extract",
                "-i", input_path,
                "--reroot", oldest_node,
@@ -175,12 +171,12 @@ def reroot_tree(tree, oldest_node):
                "--write-reroot-reference", modified_ref_path,
                "-o", rerooted_tree_path]
     try:
-        subprocess.run(command, check=True)
+        pipeline_utils.run_command(command, check=True)
     except Exception as e:
         print(f"matUtils command ({' '.join(command)}) failed: {e}", file=sys.stderr)
         sys.exit(1)
-    gbff_path = "/".join([tree, refseq_acc + ".gbff"])
-    rerooted_gbff_path = "/".join([tree, "treetime_rerooted_" + refseq_acc + ".gbff"])
+    gbff_path = str(tree / (refseq_acc + ".gbff"))
+    rerooted_gbff_path = str(tree / ("treetime_rerooted_" + refseq_acc + ".gbff"))
     alter_gbff.alter_gbff_file(gbff_path, refseq_acc, ref_path, rerooted_gbff_path)
     return rerooted_tree_path, rerooted_gbff_path
 
@@ -188,7 +184,7 @@ def reroot_tree(tree, oldest_node):
 def get_columns_string(tsv_path):
     """Return a comma-separated string listing columns of TSV file."""
     # columns=$(gunzip -c metadata.tsv.gz | head -1 | sed -re 's/\t/,/g')
-    with gzip.open(tsv_path, "rt") if tsv_path.endswith(".gz") else open(tsv_path) as f:
+    with pipeline_utils.open_maybe_gzip(tsv_path) as f:
         header = f.readline().split('\t')
         columns = ",".join([col.strip() for col in header])
         return columns
@@ -202,29 +198,31 @@ def tweak_metadata(metadata_file: str):
     with tempfile.NamedTemporaryFile(suffix='.tsv.gz', delete=False) as tmp:
         tweaked_metadata_file = tmp.name
         with gzip.GzipFile(fileobj=tmp, mode='w') as gz_file:
-            with gzip.open(metadata_file, 'rt') if metadata_file.endswith('.gz') else open(metadata_file) as f:
+            with pipeline_utils.open_maybe_gzip(metadata_file, "rb") as f:
                 for line in f:
-                    words = line.split("\t")
-                    gz_file.write("\t".join(words[1:]).encode('utf-8'))
+                    # Slice after the first tab rather than splitting out every column
+                    tab_idx = line.find(b"\t")
+                    if tab_idx >= 0:
+                        gz_file.write(line[tab_idx + 1:])
     return tweaked_metadata_file
 
 def make_taxonium(tree, rerooted_tree_path, rerooted_gbff_path):
     """Run usher_to_taxonium on rerooted_tree"""
-    tree = tree.strip("/")
-    metadata_path = "/".join([tree, "metadata.tsv.gz"])
+    tree = pathlib.Path(tree)
+    metadata_path = str(tree / "metadata.tsv.gz")
     tmp_metadata_path = tweak_metadata(metadata_path)
     columns = get_columns_string(tmp_metadata_path)
-    taxonium_jsonl_path = "/".join([tree, "timetree_rerooted.jsonl.gz"])
+    taxonium_jsonl_path = str(tree / "timetree_rerooted.jsonl.gz")
     command = ["usher_to_taxonium",
                "-i", rerooted_tree_path,
                "-m", tmp_metadata_path, 
                "--key_column", "accession",
                "--genbank", rerooted_gbff_path,
                "-c", columns,
-               "--title", "Treetime-rerooted " + tree,
+               "--title", "Treetime-rerooted " + str(tree),
                "-o", taxonium_jsonl_path]
     try:
-        subprocess.run(command, check=True)
+        pipeline_utils.run_command(command, check=True)
     except Exception as e:
         print(f"usher_to_taxonium command ({' '.join(command)}) failed: {e}", file=sys.stderr)
         sys.exit(1)
@@ -240,11 +238,12 @@ def main():
                         help=f"Minimum proportion of dates in metadata.tsv.gz that have real values (default: {default_min_real_dates})")
     args = parser.parse_args()
     min_real_dates = args.min_real_dates if args.min_real_dates else default_min_real_dates
-    run_treetime(args.virus_path, min_real_dates)
-    oldest_node = get_oldest_node(args.virus_path)
-    rerooted_tree, rerooted_gbff = reroot_tree(args.virus_path, oldest_node)
+    virus_path = pathlib.Path(args.virus_path)
+    run_treetime(virus_path, min_real_dates)
+    oldest_node = get_oldest_node(virus_path)
+    rerooted_tree, rerooted_gbff = reroot_tree(virus_path, oldest_node)
     print(f"Rerooted tree saved to: {rerooted_tree}")
-    make_taxonium(args.virus_path, rerooted_tree, rerooted_gbff)
+    make_taxonium(virus_path, rerooted_tree, rerooted_gbff)
 
 
 if __name__ == "__main__":
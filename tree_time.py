@@ -8,24 +8,21 @@ Then apply the same rerooting to viz.pb.gz.
 """
 
 import argparse
-import csv
-import gzip
 import os
-import re
 import subprocess
 import sys
-import treeswift
+import pipeline_utils
 
 #import viral_usher_trees
 
 default_min_real_dates = 0.8
 
-
 def get_dates(subdir_path):
     """Scan metadata.tsv.gz, return a dict of names -> dates and the proportion of real date values to total count"""
-    name_to_date = {}
-    with gzip.open(subdir_path + "/metadata.tsv.gz", "rt") as f:
-        header = f.readline().split('\t')
+    metadata_path = os.path.join(subdir_path, "metadata.tsv.gz")
+    index_path = pipeline_utils.cache_path(metadata_path, ".gzidx")
+    with pipeline_utils.open_maybe_gzip(metadata_path, "rb", index_path=index_path) as f:
+        header = f.readline().decode().split('\t')
         for idx, field in enumerate(header):
             header[idx] = field.strip()
         name_idx = header.index('strain')
@@ -36,26 +33,25 @@ def get_dates(subdir_path):
         if date_idx < 0:
             print(subdir_path + "/metadata.tsv.gz" + " does not have date column", file=sys.stderr)
             sys.exit(1)
-        line_count = 0
-        real_date_count = 0
-        for line in f:
-            fields = line.rstrip().split("\t")
-            name = fields[name_idx]
-            date = fields[date_idx]
-            if re.match('^[0-9]{4}', date):
-                name_to_date[name] = date
-                real_date_count += 1
-            line_count += 1
-            print(name)
-            print(date)
+        name_to_date, real_date_count, line_count = pipeline_utils.read_dates(f, name_idx, date_idx)
+    print(f"{subdir_path}/metadata.tsv.gz: {real_date_count} of {line_count} rows have dates")
     return name_to_date, (real_date_count / line_count)
 
 
 def scale_branch_lengths(subdir_path, newick_out, refseq_len):
-    """Use treeswift (included with taxoniumtools) to scale branch lengths as expected by treetime"""
-    tree = treeswift.read_tree_newick(subdir_path + "/viz.nwk.gz")
-    tree.scale_edges(1.0 / refseq_len)
-    tree.write_tree_newick(subdir_path + "/" + newick_out)
+    """Scale branch lengths to substitutions per site as expected by treetime"""
+    input_path = subdir_path + "/viz.nwk.gz"
+    newick_out_path = subdir_path + "/" + newick_out
+    # Skip the work if the output was made from the same input file and reference length
+    stamp_path = pipeline_utils.cache_path(newick_out_path, ".stamp")
+    stamp = repr((os.path.getmtime(input_path), refseq_len))
+    if os.path.exists(newick_out_path) and pipeline_utils.read_stamp(stamp_path) == stamp:
+        return
+    with pipeline_utils.open_maybe_gzip(input_path, "rb") as f:
+        newick = f.read()
+    with open(newick_out_path, "wb") as f:
+        f.write(pipeline_utils.scale_newick(newick, 1.0 / refseq_len))
+    pipeline_utils.write_stamp(stamp_path, stamp)
 
 
 def make_dates_csv(subdir_path, dates_out, name_to_date):
@@ -63,24 +59,17 @@ def make_dates_csv(subdir_path, dates_out, name_to_date):
     with open(subdir_path + "/" + dates_out, "w") as f:
         f.write(",".join(["name", "date"]) + "\n")
         for name, date in name_to_date.items():
-            print(name)
-            if re.match('^[0-9]{4}$', date):
-                date += "-XX-XX"
-            elif re.match('^[0-9]{4}-[0-9]{2}$', date):
-                date += "-XX"
-            f.write(",".join([name, date]) + "\n")
+            f.write(",".join([name, pipeline_utils.pad_date(date)]) + "\n")
 
 
 def get_refseq_len(subdir_path):
-    """Get refseq_length value from output_stats.tsv"""
-    with open(subdir_path + "/output_stats.tsv", "r", newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f, delimiter='\t')
-        fieldnames = reader.fieldnames
-        if "refseq_length" not in fieldnames:
+    """Get refseq_length value from output_stats.tsv (the same on every row, so only the first is read)"""
+    with open(subdir_path + "/output_stats.tsv", "r", encoding='utf-8') as f:
+        header = f.readline().rstrip("\r\n").split("\t")
+        if "refseq_length" not in header:
             return -1
-        for row in reader:
-            refseq_length = int(row["refseq_length"])
-    return refseq_length
+        first_row = f.readline().rstrip("\r\n").split("\t")
+    return int(first_row[header.index("refseq_length")])
 
 
 def run_treetime(virus, directory, min_real_dates):
@@ -127,7 +116,7 @@ def run_treetime(virus, directory, min_real_dates):
     '''
     with open(subdir_path + "/treetime.log", "w") as outfile:
         try:
-            subprocess.run(command, check=True, stdout=outfile, stderr=subprocess.STDOUT)
+            pipeline_utils.run_command(command, check=True, stdout=outfile, stderr=subprocess.STDOUT)
             outfile.write("\n[OK] treetime finished successfully\n")
         except subprocess.CalledProcessError as e:
             outfile.write(f"\n[ERROR] treetime command ({' '.join(command)}) failed with return code {e.returncode}\n")